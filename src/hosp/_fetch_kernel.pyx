@@ -0,0 +1,69 @@
+# cython: language_level=3
+"""
+compiled feature assembly for batches of samples, see preparation.fetch_batch.
+"""
+import numpy as np
+
+cimport cython
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef fetch_batch(double[:, :, ::1] series, Py_ssize_t[:, ::1] lengths, 
+                Py_ssize_t[::1] cells, Py_ssize_t[::1] weeks, 
+                Py_ssize_t lag, Py_ssize_t left_window, Py_ssize_t right_window, 
+                Py_ssize_t backfill_window):
+    """
+    fetch the predictors of a batch of samples from tabulated records.
+
+    Args:
+        series, lengths - the tabulated records (see preparation.tabulate)
+        cells, weeks - the cell and epiweek index of each sample
+        lag - the current time lag
+        left_window, right_window - represent the interval 
+            [epiweek - left_window, epiweek + right_window]
+        backfill_window - the "width" of backfill
+    
+    Returns:
+        the predictors of the samples, stacked as rows
+
+    Raises:
+        ValueError - if a record is too short for the lag and window
+    """
+    cdef Py_ssize_t n = cells.shape[0], n_weeks = series.shape[1]
+    cdef Py_ssize_t width = backfill_window + 1
+    cdef Py_ssize_t n_pos = left_window + right_window + 1
+    cdef Py_ssize_t i, c, w, pos, t, start, end
+    # the sample with a short record, if any
+    cdef Py_ssize_t short = -1
+
+    X = np.zeros((n, n_pos * width), dtype=np.float32)
+    cdef float[:, ::1] X_view = X
+
+    with nogil:
+        for i in range(n):
+            c = cells[i]
+
+            for pos in range(n_pos):
+                w = weeks[i] - left_window + pos
+                if w < 0 or w >= n_weeks or lengths[c, w] == 0:
+                    continue
+                # take the data from start to end, aligned to the right
+                end = lag - pos + left_window + 1
+                start = end - width
+                if end < 0:
+                    end = 0
+                if start < 0:
+                    start = 0
+                # stop before reading past the record
+                if end > lengths[c, w]:
+                    short = i
+                    break
+
+                for t in range(start, end):
+                    X_view[i, pos * width + width - (end - t)] = <float> series[c, w, t]
+            if short >= 0:
+                break
+
+    if short >= 0:
+        raise ValueError('record too short for lag and window at sample ' + str(short))
+    return X
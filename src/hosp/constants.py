@@ -12,6 +12,8 @@ GROUP_DESCRIPTIONS = ['Ages 0-4', 'Ages 5-17', 'Ages 18-49',
 
 # hyperparameters for machine learning models
 RIDGE_ALPHA = 0.5
+# models solved in closed form from gram statistics
+CLOSED_FORM_MODELS = ['lin', 'ridge']
 ESTIMATIORS, DEPTH = 50, 3
 # hyperparameters for quantile models
 UPPER_QUANT, MID_QUANT, LOWER_QUANT = 0.95, 0.5, 0.05
@@ -20,3 +22,7 @@ EPS = 0.05
 FIRST_YEAR, YEAR_WINDOW = 2012, 1
 # hyperparameters for prediction
 PENALTY = 0.03
+# windows without improvement before the window search stops
+PATIENCE = 2
+# number of parallel jobs for location groups and age groupings
+N_JOBS = -1
@@ -5,6 +5,7 @@ from abc import abstractmethod
 
 from sklearn.linear_model import LinearRegression, Ridge
 from sklearn.ensemble import GradientBoostingRegressor
+from scipy.linalg import cho_factor, cho_solve
 
 import bootstrapped.bootstrap as bs
 import bootstrapped.stats_functions as stat_f
@@ -69,7 +70,146 @@ class RegModel(object):
         """
         return self.model.predict(X) + self.res
 
-class RegLinear(RegModel):
+class GramStats(object):
+    """
+    centered second moments of a design matrix. closed-form regressions on 
+    any subset of its columns are solved from the corresponding sub-blocks, 
+    without revisiting the training data.
+
+    if the subsets are nested, i.e. each is a prefix of a common column order,
+    ridge regressions share one cholesky factor: the factor of a leading block
+    is the leading block of the factor.
+    """
+
+    def __init__(self, X, y):
+        # moments are accumulated in double precision for the solves
+        self.x_mean = X.mean(axis=0, dtype=np.float64)
+        self.y_mean = y.mean(dtype=np.float64)
+        X_c = X - self.x_mean
+        self.gram = np.dot(X_c.T, X_c)
+        self.moment = np.dot(X_c.T, y - self.y_mean)
+        # cholesky factor of the ordered gram matrix, with its order, 
+        # the rank of each column in the order, and the ridge penalty
+        self.factor = None
+        self.factor_order = None
+        self.factor_rank = None
+        self.factor_alpha = None
+
+    def _solve_prefix(self, cols, alpha, order):
+        """
+        solve the ridge problem for columns forming a prefix of an order,
+        factorizing the ordered gram matrix only when the order or penalty changes.
+
+        Args:
+            cols - the column indices of the subset
+            alpha - the ridge penalty
+            order - the column order of nested subsets
+        
+        Returns:
+            coef - the regression coefficients following the order of cols, 
+                or None if cols is not a prefix of the order
+        """
+        if self.factor is None or self.factor_alpha != alpha or \
+                not np.array_equal(self.factor_order, order):
+            gram = self.gram[np.ix_(order, order)]
+            self.factor, _ = cho_factor(gram + alpha * np.eye(len(order)), lower=True)
+            self.factor_order = order
+            self.factor_rank = np.full(len(self.gram), len(order))
+            self.factor_rank[order] = np.arange(len(order))
+            self.factor_alpha = alpha
+
+        k = len(cols)
+        if not np.all(self.factor_rank[cols] < k):
+            return None
+        coef = cho_solve((self.factor[:k, :k], True), self.moment[order[:k]])
+        return coef[self.factor_rank[cols]]
+
+    def solve(self, cols, alpha, order=None):
+        """
+        solve the (ridge) least squares problem on a subset of columns.
+
+        Args:
+            cols - the column indices of the subset
+            alpha - the ridge penalty, 0 for ordinary least squares
+            order - (optional) a column order in which cols is a prefix, 
+                shared by nested subsets
+        
+        Returns:
+            coef, intercept - the regression coefficients and intercept
+        """
+        coef = None
+        if alpha > 0 and order is not None:
+            coef = self._solve_prefix(cols, alpha, order)
+        if coef is None:
+            gram = self.gram[np.ix_(cols, cols)]
+            if alpha > 0:
+                coef = np.linalg.solve(gram + alpha * np.eye(len(cols)), self.moment[cols])
+            else:
+                coef = np.linalg.lstsq(gram, self.moment[cols], rcond=None)[0]
+        intercept = self.y_mean - np.dot(self.x_mean[cols], coef)
+        return coef, intercept
+
+class LinearFit(object):
+    """
+    a linear model with given coefficients and intercept.
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef = coef
+        self.intercept = intercept
+    
+    def predict(self, X):
+        """
+        perform prediction for testing data.
+
+        Args:
+            X - testing data.
+        
+        Returns:
+            predicted values.
+        """
+        return np.dot(X, self.coef) + self.intercept
+
+class RegClosedForm(RegModel):
+    """
+    An abstract class for regression models with closed-form solutions.
+    """
+
+    alpha = 0.0
+
+    def fit_gram(self, X, y, stats, cols, order=None):
+        """
+        fit the model from the gram statistics of a master design matrix.
+
+        Args:
+            X - training input, i.e. the selected columns of the master matrix
+            y - training target
+            stats - the gram statistics of the master matrix
+            cols - the column indices of X within the master matrix
+            order - (optional) a column order in which cols is a prefix
+        
+        Returns:
+            None
+        """
+        self.model = LinearFit(*stats.solve(cols, self.alpha, order))
+        train_res = y - self.model.predict(X)
+        # bootstrap from training residuals
+        self.res = self._get_quantile(train_res)
+
+    def get_linear_terms(self):
+        """
+        get the coefficients and intercept of the fitted quantile model.
+
+        Returns:
+            coef, intercept - the prediction is np.dot(X, coef) + intercept
+        """
+        if isinstance(self.model, LinearFit):
+            coef, intercept = self.model.coef, self.model.intercept
+        else:
+            coef, intercept = self.model.coef_, self.model.intercept_
+        return coef, intercept + self.res
+
+class RegLinear(RegClosedForm):
     """
     mean linear regression model.
     """
@@ -78,11 +218,13 @@ class RegLinear(RegModel):
         super().__init__(quantile)
         self.model = LinearRegression()
 
-class RegRidge(RegModel):
+class RegRidge(RegClosedForm):
     """
     mean ridge regression model.
     """
 
+    alpha = RIDGE_ALPHA
+
     def __init__(self, quantile):
         super().__init__(quantile)
         self.model = Ridge(alpha=RIDGE_ALPHA)
@@ -145,6 +287,9 @@ class QuantModel(object):
             c, G, h - constraint matrices 
         """
         n_train, p = X_train.shape
+        # cvxopt only accepts double precision
+        X_train = np.asarray(X_train, dtype=np.float64)
+        y_train = np.asarray(y_train, dtype=np.float64)
 
         # set up a few building blocks
         train_zero_mat = np.zeros((2 * n_train, n_train + p + 1))
@@ -8,11 +8,31 @@ import flu_contest.src.hosp.hosp_utils as hosp_utils
 from flu_contest.src.hosp.tools import *
 from delphi_epidata.src.client.delphi_epidata import Epidata
 # third party
+import os
 import pickle
 import numpy as np
-import matplotlib.pyplot as plt
 
 from tqdm import tqdm
+from collections.abc import Mapping
+
+# use the compiled feature assembly when it has been built, e.g. by
+# cythonize -i src/hosp/_fetch_kernel.pyx
+# building on import with pyximport is opt-in by setting HOSP_PYXIMPORT=1
+try:
+    from flu_contest.src.hosp._fetch_kernel import fetch_batch as _compiled_fetch_batch
+except ImportError:
+    _compiled_fetch_batch = None
+
+if _compiled_fetch_batch is None and os.environ.get('HOSP_PYXIMPORT') == '1':
+    try:
+        import pyximport
+        py_importer, pyx_importer = pyximport.install(language_level=3)
+        try:
+            from flu_contest.src.hosp._fetch_kernel import fetch_batch as _compiled_fetch_batch
+        finally:
+            pyximport.uninstall(py_importer, pyx_importer)
+    except ImportError:
+        _compiled_fetch_batch = None
 
 def update_data(locations, time_period, max_lag):
     """ 
@@ -45,11 +65,163 @@ def update_data(locations, time_period, max_lag):
     # fill and save the queried results
     fill_data(data, max_lag)
     write_data(data, 'data.txt')
-    # load queried data into a pickle file
-    with open('data.pickle', 'wb') as handle:
-        pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # store queried data as arrays for memory-mapped loading
+    write_npz(data, 'data.npz')
     return data
 
+class NpzData(Mapping):
+    """
+    read-only view of the data source stored by write_npz. records are 
+    looked up by (epiweek, group, location) as in the dictionary data source,
+    and are returned as views into the memory-mapped feature array.
+
+    records are sorted by location, group and epiweek, so each record gets
+    an increasing integer code and is located by binary search over the codes,
+    without building a python object per record.
+    """
+
+    # epiweeks are encoded as YYYYWW
+    week_base = 10 ** 6
+
+    def __init__(self, features, lengths, locations, groups, epiweeks):
+        self.features = features
+        self.lengths = lengths
+        self.locations = locations
+        self.groups = groups
+        self.epiweeks = epiweeks
+        # index of each distinct location, in sorted order
+        new_location = np.ones(len(locations), dtype=bool)
+        new_location[1:] = locations[1:] != locations[:-1]
+        self.location_index = {location: l_idx for l_idx, location 
+                                in enumerate(locations[new_location].tolist())}
+        self.num_groups = int(groups.max()) + 1 if len(groups) > 0 else 1
+        self.codes = self._encode(np.cumsum(new_location) - 1, groups, epiweeks)
+
+    def _encode(self, l_inds, groups, epiweeks):
+        l_inds = np.asarray(l_inds, dtype=np.int64)
+        groups = np.asarray(groups, dtype=np.int64)
+        return (l_inds * self.num_groups + groups) * self.week_base + epiweeks
+
+    def rows(self, epiweeks, groups, locations):
+        """
+        locate the rows of records, the arguments are broadcast together.
+
+        Args:
+            epiweeks, groups, locations - the keys of the records
+        
+        Returns:
+            the row of each record, -1 if missing
+        """
+        locations = np.asarray(locations, dtype=object)
+        l_inds = np.array([self.location_index.get(location, -1) 
+                            for location in locations.ravel()], dtype=np.int64)
+        l_inds = l_inds.reshape(locations.shape)
+        groups = np.asarray(groups, dtype=np.int64)
+        codes = self._encode(l_inds, groups, np.asarray(epiweeks, dtype=np.int64))
+
+        if len(self.codes) == 0:
+            return np.full(codes.shape, -1, dtype=np.intp)
+        rows = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        found = (l_inds >= 0) & (groups >= 0) & (groups < self.num_groups) & \
+                (self.codes[rows] == codes)
+        return np.where(found, rows, -1)
+
+    def __getitem__(self, key):
+        epiweek, group, location = key
+        row = self.rows(epiweek, group, [location])[0]
+        if row < 0:
+            raise KeyError(key)
+        return self.features[row, :self.lengths[row]]
+
+    def __contains__(self, key):
+        epiweek, group, location = key
+        return self.rows(epiweek, group, [location])[0] >= 0
+
+    def __iter__(self):
+        return zip(self.epiweeks.tolist(), self.groups.tolist(), self.locations.tolist())
+
+    def __len__(self):
+        return len(self.codes)
+
+def to_npz_data(data):
+    """
+    arrange the data source as arrays, with records sorted by location, group 
+    and epiweek and padded by their final values.
+
+    Args:
+        data - the data source (as python dictionary)
+    
+    Returns:
+        the data source as a read-only mapping, see NpzData
+    """
+    if isinstance(data, NpzData):
+        return data
+
+    keys = sorted(data.keys(), key=lambda key: (key[2], key[1], key[0]))
+    lengths = np.array([len(data[key]) for key in keys], dtype=np.intp)
+    features = np.zeros((len(keys), lengths.max() if len(keys) > 0 else 0))
+
+    for row, key in enumerate(keys):
+        record = data[key]
+        features[row, :len(record)] = record
+        features[row, len(record):] = record[-1]
+
+    return NpzData(features, lengths, 
+                    np.array([key[2] for key in keys], dtype=str), 
+                    np.array([key[1] for key in keys], dtype=np.intp), 
+                    np.array([key[0] for key in keys], dtype=np.intp))
+
+def write_npz(data, path):
+    """
+    store the data source as arrays (see to_npz_data). the features are written
+    next to the npz file as a .npy file, since npz members cannot be 
+    memory-mapped.
+
+    Args:
+        data - the data source
+        path - the path of the npz file
+    
+    Returns:
+        None
+    """
+    data = to_npz_data(data)
+    np.save(os.path.splitext(path)[0] + '.npy', data.features)
+    np.savez(path, 
+            lengths=data.lengths,
+            locations=data.locations, 
+            groups=data.groups, 
+            epiweeks=data.epiweeks)
+
+def pickle_to_npz(path, npz_path='data.npz'):
+    """
+    convert a pickled data source to the format of write_npz.
+
+    Args:
+        path - the path of the pickle file
+        npz_path - the path of the npz file
+    
+    Returns:
+        None
+    """
+    with open(path, 'rb') as handle:
+        data = pickle.load(handle)
+    write_npz(data, npz_path)
+
+def load_npz(path='data.npz'):
+    """
+    load the data source stored by write_npz, with memory-mapped features.
+
+    Args:
+        path - the path of the npz file
+    
+    Returns:
+        the data source as a read-only mapping
+    """
+    features = np.load(os.path.splitext(path)[0] + '.npy', mmap_mode='r')
+    with np.load(path) as arrays:
+        return NpzData(features, arrays['lengths'], arrays['locations'], 
+                        arrays['groups'], arrays['epiweeks'])
+
 def fetch(data, location, group, epiweek, lag, left_window, right_window, backfill_window):
     """ 
     fetch data for a location and age group specified by epiweek and time window.
@@ -65,7 +237,8 @@ def fetch(data, location, group, epiweek, lag, left_window, right_window, backfi
         backfill_window - the "width" of backfill
     
     Returns:
-        the predictors and ground truth for each epiweek
+        the predictors as a C-contiguous row of shape (1, d), 
+        and the ground truth for each epiweek
     """
     # get the time period
     period = hosp_utils.get_window(epiweek, left_window, right_window)
@@ -73,7 +246,7 @@ def fetch(data, location, group, epiweek, lag, left_window, right_window, backfi
     cur_y = data[(epiweek, group, location)][lag]
     y = data[(epiweek, group, location)][-1:]
     # create x, and fill entries by 0
-    x = np.zeros((left_window + right_window + 1, backfill_window + 1))
+    x = np.zeros((left_window + right_window + 1, backfill_window + 1), dtype=np.float32)
     
     for pos, epiweek in enumerate(period):
         # for each epiweek, collect data for regression
@@ -84,10 +257,147 @@ def fetch(data, location, group, epiweek, lag, left_window, right_window, backfi
             fill_length = max(0, lag - pos + left_window + 1) - max(0, start_ind)
             x[pos, backfill_window + 1 - fill_length:] = \
                 record[max(0, start_ind): max(0, lag - pos + left_window + 1)]
-    # vectorize collected data
-    x = x.reshape(-1, 1)
+    # vectorize collected data as a single row
+    x = x.reshape(1, -1)
     return x, cur_y, y
 
+def tabulate(data, locations, groups, first_week, last_week):
+    """
+    arrange the records of locations and groups as dense arrays over 
+    a contiguous range of epiweeks.
+
+    Args:
+        data - the data source (included all epiweeks with all lags)
+        locations - a list of all locations to tabulate
+        groups - a list of all age groups to tabulate
+        first_week, last_week - the range of epiweeks to tabulate
+    
+    Returns:
+        series - the records of shape (cells, epiweeks, lags), where the cell of
+            a location and group is l_idx * len(groups) + g_idx, padded by
+            the final value of each record
+        lengths - the record lengths of shape (cells, epiweeks), 0 if missing
+        week_index - the index of each epiweek in the range
+    """
+    epiweeks = list(utils.range_epiweeks(first_week, last_week, inclusive=True))
+    week_index = {epiweek: w_idx for w_idx, epiweek in enumerate(epiweeks)}
+
+    if isinstance(data, NpzData):
+        # stored records are already padded, gather them by row
+        rows = data.rows(np.array(epiweeks)[None, None, :], 
+                        np.array(groups)[None, :, None], 
+                        np.array(locations, dtype=object)[:, None, None])
+        rows = rows.reshape(len(locations) * len(groups), len(epiweeks))
+        found = rows >= 0
+        lengths = np.zeros(rows.shape, dtype=np.intp)
+        lengths[found] = data.lengths[rows[found]]
+        # the lag axis fits the longest gathered record
+        max_length = max(lengths.max(initial=0), 1)
+        series = np.zeros(rows.shape + (max_length,))
+        if np.any(found):
+            series[found] = data.features[rows[found], :max_length]
+        return series, lengths, week_index
+
+    # gather the records first, the lag axis fits the longest of them
+    records = []
+    for l_idx, location in enumerate(locations):
+        for g_idx, group in enumerate(groups):
+            cell = l_idx * len(groups) + g_idx
+
+            for w_idx, epiweek in enumerate(epiweeks):
+                if (epiweek, group, location) in data:
+                    records.append((cell, w_idx, data[(epiweek, group, location)]))
+    max_length = max([len(record) for _, _, record in records], default=1)
+
+    series = np.zeros((len(locations) * len(groups), len(epiweeks), max_length))
+    lengths = np.zeros((len(locations) * len(groups), len(epiweeks)), dtype=np.intp)
+
+    for cell, w_idx, record in records:
+        series[cell, w_idx, :len(record)] = record
+        series[cell, w_idx, len(record):] = record[-1]
+        lengths[cell, w_idx] = len(record)
+    return series, lengths, week_index
+
+def _fetch_batch(series, lengths, cells, weeks, lag, left_window, right_window, backfill_window):
+    """
+    python version of the compiled feature assembly, see fetch_batch.
+    """
+    width = backfill_window + 1
+    n_pos = left_window + right_window + 1
+    X = np.zeros((len(cells), n_pos * width), dtype=np.float32)
+
+    for i in range(len(cells)):
+        for pos in range(n_pos):
+            w = weeks[i] - left_window + pos
+            if w < 0 or w >= series.shape[1] or lengths[cells[i], w] == 0:
+                continue
+            # take the data from start to end, aligned to the right
+            end = max(0, lag - pos + left_window + 1)
+            start = max(0, end - width)
+            if end > lengths[cells[i], w]:
+                raise ValueError('record too short for lag and window at sample ' + str(i))
+            X[i, pos * width + width - (end - start): (pos + 1) * width] = \
+                series[cells[i], w, start: end]
+    return X
+
+def fetch_batch(series, lengths, cells, weeks, lag, left_window, right_window, backfill_window):
+    """
+    fetch the predictors of a batch of samples from tabulated records, 
+    equivalent to stacking the predictors from fetch as rows.
+
+    Args:
+        series, lengths - the tabulated records (see tabulate)
+        cells, weeks - the cell and epiweek index of each sample
+        lag - the current time lag
+        left_window, right_window - represent the interval 
+            [epiweek - left_window, epiweek + right_window]
+        backfill_window - the "width" of backfill
+    
+    Returns:
+        the predictors of the samples, stacked as rows
+
+    Raises:
+        ValueError - if a record is too short for the lag and window, as in fetch
+    """
+    cells = np.ascontiguousarray(cells, dtype=np.intp)
+    weeks = np.ascontiguousarray(weeks, dtype=np.intp)
+
+    if _compiled_fetch_batch is not None:
+        return _compiled_fetch_batch(np.ascontiguousarray(series, dtype=np.float64), 
+                                    np.ascontiguousarray(lengths, dtype=np.intp), 
+                                    cells, weeks, 
+                                    lag, left_window, right_window, backfill_window)
+    return _fetch_batch(series, lengths, cells, weeks, 
+                        lag, left_window, right_window, backfill_window)
+
+def select_columns(left_window, right_window, backfill_window, 
+                    sub_left_window, sub_backfill_window):
+    """
+    locate the predictors of a smaller window and backfill within the 
+    predictors fetched with a larger window and backfill.
+
+    the rows fetched for a smaller backfill are the latest entries of the rows
+    for a larger backfill, and a smaller left window drops the earliest rows,
+    so the smaller predictors are a subset of columns of the larger ones.
+
+    the columns are ordered by backfill depth, latest releases first, so for
+    a fixed window the columns of each smaller backfill form a prefix.
+
+    Args:
+        left_window, right_window, backfill_window - the setting of the 
+            fetched predictors
+        sub_left_window, sub_backfill_window - the smaller setting 
+            (the right window is kept)
+    
+    Returns:
+        the column indices of the smaller predictors, in backfill order
+    """
+    columns = np.arange((left_window + right_window + 1) * (backfill_window + 1))
+    columns = columns.reshape(left_window + right_window + 1, backfill_window + 1)
+    columns = columns[left_window - sub_left_window:, 
+                        backfill_window - sub_backfill_window:]
+    return columns[:, ::-1].T.reshape(-1)
+
 def prepare(data, locations, groups, periods, lag, left_window, right_window, backfill_window):
     """
     collect data from different locations, groups, and time periods.
@@ -121,7 +431,9 @@ def prepare(data, locations, groups, periods, lag, left_window, right_window, ba
                         if np.any(y):
                             total_X.append(x)
                             total_Y.append(y)
-    # vectorize data
-    total_X = np.vstack(total_X).reshape(len(total_X), -1)  
+    # vectorize data as contiguous single precision arrays
+    total_X = np.vstack(total_X)
     total_Y = np.array(total_Y).squeeze()
+    total_X = np.ascontiguousarray(total_X, dtype=np.float32)
+    total_Y = np.ascontiguousarray(total_Y, dtype=np.float32)
     return total_X, total_Y
@@ -10,20 +10,24 @@ Functionalities include:
 import flu_contest.src.hosp.preparation as preparation
 import flu_contest.src.hosp.hosp_utils as hosp_utils
 import flu_contest.src.hosp.ml_utils as ml_utils
+import flu_contest.src.hosp.regression_kernels as regression_kernels
 import utils.epiweek as utils
 
 from flu_contest.src.hosp.tools import *
 from flu_contest.src.hosp.constants import *
 # third party
 import os
-import pickle
 import numpy as np
+import matplotlib
+# reports are rendered headless
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import seaborn as sns
 
 from tqdm import tqdm
-from sklearn import metrics
+from joblib import Parallel, delayed, parallel_backend, cpu_count, effective_n_jobs
 
-def train_model(X, Y, model_type):
+def train_model(X, Y, model_type, stats=None, cols=None, order=None):
     """
     build SVR regression model for final-value prediction.
 
@@ -31,6 +35,11 @@ def train_model(X, Y, model_type):
         X - training input
         Y - training output
         model_type - the name of machine learning model
+        stats, cols - (optional) the gram statistics of a master design matrix 
+            and the column indices of X within it. linear and ridge models are
+            then solved from the statistics instead of being refitted.
+        order - (optional) a column order of the master matrix in which cols 
+            is a prefix, shared by nested column subsets
     
     Returns:
         model - the trained machine learning model
@@ -67,17 +76,151 @@ def train_model(X, Y, model_type):
             model = ml_utils.QuantGBDT(MID_QUANT)
             model_lower = ml_utils.QuantGBDT(LOWER_QUANT)
         
-        model_upper.fit(X, Y)
-        model.fit(X, Y)
-        model_lower.fit(X, Y)
+        if stats is not None and model_type in CLOSED_FORM_MODELS:
+            model_upper.fit_gram(X, Y, stats, cols, order)
+            model.fit_gram(X, Y, stats, cols, order)
+            model_lower.fit_gram(X, Y, stats, cols, order)
+        else:
+            model_upper.fit(X, Y)
+            model.fit(X, Y)
+            model_lower.fit(X, Y)
 
     return model_upper, model, model_lower
 
+def get_models(data, 
+                locations, groups, 
+                model_periods, lag, 
+                left_window, right_window, backfill_window, 
+                model_type, model_cache=None, max_left=None, max_backfill=None):
+    """
+    prepare training data and train models, reusing the trained models
+    from the cache when the same training setting has been seen before.
+
+    training data is prepared once with the maximum window and backfill and 
+    cached, smaller windows and backfills select its columns. the columns of 
+    the current window are kept in a buffer in backfill order, so that each 
+    backfill trains on its leading columns. linear and ridge models are solved
+    from the gram statistics of the cached data, where ridge models of all
+    backfills in a window share one cholesky factor.
+
+    Args:
+        data - the data source
+        locations - the list of locations for machine learning model
+        groups - the list of groups for machine learning model
+        model_periods - the training seasons
+        lag - the current time lag
+        left_window, right_window - the time period considered for regression: 
+            [cur_time - left_window, cur_time + right_window]
+        backfill_window - the backfill period: [cur_time-window, cur_time]
+        model_type - the name of machine learning model
+        model_cache - (optional) a dictionary of trained models and training data, 
+            keyed by the training setting
+        max_left, max_backfill - (optional) the largest left window and backfill 
+            that the training data is shared with, default to left_window and
+            backfill_window
+    
+    Returns:
+        model_upper, model, model_lower - the trained models
+    """
+    if model_cache is None:
+        model_cache = {}
+    if max_left is None:
+        max_left = left_window
+    if max_backfill is None:
+        max_backfill = backfill_window
+
+    setting = (tuple(locations), tuple(groups), tuple(model_periods), lag, right_window)
+    model_key = ('models',) + setting + (left_window, backfill_window, model_type)
+    data_key = ('data',) + setting + (max_left, max_backfill, model_type)
+
+    if model_key in model_cache:
+        return model_cache[model_key]
+
+    if data_key not in model_cache:
+        X, Y = preparation.prepare(data, locations, groups, 
+                                    model_periods, lag, 
+                                    max_left, right_window, max_backfill)
+        stats = None
+        if model_type in CLOSED_FORM_MODELS:
+            stats = ml_utils.GramStats(X, Y)
+        model_cache[data_key] = {'X': X, 'Y': Y, 'stats': stats, 
+                                'buffer': np.empty_like(X), 'window': None}
+
+    cached = model_cache[data_key]
+    # the columns of the window in backfill order, and those of the backfill
+    order = preparation.select_columns(max_left, right_window, max_backfill, 
+                                        left_window, max_backfill)
+    cols = preparation.select_columns(max_left, right_window, max_backfill, 
+                                        left_window, backfill_window)
+    if cached['window'] != left_window:
+        cached['buffer'][:, :len(order)] = cached['X'][:, order]
+        cached['window'] = left_window
+
+    models = train_model(cached['buffer'][:, :len(cols)], cached['Y'], model_type, 
+                        cached['stats'], cols, order)
+
+    model_cache[model_key] = models
+    return models
+
+def collect_validation(data, 
+                        locations, groups, 
+                        valid_weeks, lag, 
+                        left_window, right_window, backfill_window):
+    """
+    fetch the validation inputs and ground truth for a time period.
+
+    Args:
+        data - the data source
+        locations - the list of locations for machine learning model
+        groups - the list of groups for machine learning model
+        valid_weeks - the epiweeks of the time period
+        lag - the current time lag
+        left_window, right_window - the time period considered for regression: 
+            [cur_time - left_window, cur_time + right_window]
+        backfill_window - the backfill period: [cur_time-window, cur_time]
+    
+    Returns:
+        X_val - the validation inputs, stacked as rows
+        inds - the (location, group, record) indices of each row
+        cur_truth - the final value of series at current time
+        ground_truth - the final values provided by CDC after backfill
+        valid_counts - the number of recorded epiweeks for each location and group
+        week_pos - the index in valid_weeks of each record, -1 where unrecorded
+    """
+    shape = (len(locations), len(groups), len(valid_weeks))
+    ground_truth = np.full(shape, np.nan, dtype=np.float32)
+    cur_truth = np.full(shape, np.nan, dtype=np.float32)
+    # tabulate the records around the period for batched feature assembly
+    series, lengths, week_index = preparation.tabulate(data, locations, groups, 
+                                    utils.add_epiweeks(valid_weeks[0], -left_window), 
+                                    utils.add_epiweeks(valid_weeks[-1], right_window))
+    week_inds = np.array([week_index[epiweek] for epiweek in valid_weeks], dtype=np.intp)
+    # a sample exists if its record is tabulated
+    valid_mask = lengths[:, week_inds].reshape(shape) > 0
+    valid_counts = valid_mask.sum(axis=-1)
+    # samples are ordered by epiweek, then location and group, and the records 
+    # of each location and group are written contiguously from the start
+    e_inds, l_inds, g_inds = np.nonzero(valid_mask.transpose(2, 0, 1))
+    w_inds = (np.cumsum(valid_mask, axis=-1) - 1)[l_inds, g_inds, e_inds]
+    cells = l_inds * len(groups) + g_inds
+    weeks = week_inds[e_inds]
+    # record ground truth, records are padded by their final values
+    cur_truth[l_inds, g_inds, w_inds] = series[cells, weeks, lag]
+    ground_truth[l_inds, g_inds, w_inds] = series[cells, weeks, -1]
+
+    X_val = preparation.fetch_batch(series, lengths, cells, weeks, 
+                                    lag, left_window, right_window, backfill_window)
+    inds = np.stack((l_inds, g_inds, w_inds))
+    week_pos = np.full(shape, -1, dtype=np.intp)
+    week_pos[l_inds, g_inds, w_inds] = e_inds
+    return X_val, inds, cur_truth, ground_truth, valid_counts, week_pos
+
 def validate(data, 
             locations, groups, 
             time_period, lag, 
             left_window, right_window, backfill_window,
-            mode, model_type):
+            mode, model_type, model_cache=None, max_left=None, max_backfill=None, 
+            return_sums=False):
     """
     apply cross-validation for a time period with other seasons
     as training data.
@@ -95,6 +238,12 @@ def validate(data,
             prev: use the seasons within year window as training data
             all: use all previous seasons as training data
         model_type - the name of machine learning model
+        model_cache - (optional) a dictionary of trained models and data 
+            shared across calls
+        max_left, max_backfill - (optional) the largest left window and backfill 
+            sharing the training and validation data
+        return_sums - (optional) if true, only score the point predictions and
+            return the sums of the R^2 statistic instead of the results
     
     Returns:
         valid_weeks - the active epiweeks for flu
@@ -102,9 +251,26 @@ def validate(data,
             the predicted final values, the latter two form confidence intervals
         cur_truth - the final value of series at current time
         ground_truth - the final values provided by CDC after backfill
+        valid_counts - the number of recorded epiweeks for each location and group
+        week_pos - the index in valid_weeks of each record, -1 where unrecorded
+
+        results are arrays of shape (locations, groups, epiweeks), where the records
+        of each location and group fill the first valid_counts entries and the 
+        rest are nan.
+
+        if return_sums is true, returns ss_res, ss_tot, n - the residual and 
+        total sums of squares of the point predictions, and the number of 
+        recorded epiweeks.
     """
+    if model_cache is None:
+        model_cache = {}
+    if max_left is None:
+        max_left = left_window
+    if max_backfill is None:
+        max_backfill = backfill_window
+
     start_year = hosp_utils.get_start_year(time_period[0])
-    period = hosp_utils.unravel(time_period)
+    valid_weeks = list(hosp_utils.unravel(time_period))
     model_periods = []
 
     # obtain all training seasons
@@ -115,54 +281,68 @@ def validate(data,
         for year in range(max(FIRST_YEAR, start_year - YEAR_WINDOW), start_year):
             model_periods.append(hosp_utils.get_period(year, 40, 17))
     # train models
-    X, Y = preparation.prepare(data, locations, groups, 
-                                model_periods, lag, 
-                                left_window, right_window, backfill_window)
-    model_upper, model, model_lower = train_model(X, Y, model_type)
-    # result collectors
-    predictions = create_double_list([], len(locations), len(groups))
-    predictions_lower = create_double_list([], len(locations), len(groups))
-    predictions_upper = create_double_list([], len(locations), len(groups))
-    ground_truth = create_double_list([], len(locations), len(groups))
-    cur_truth = create_double_list([], len(locations), len(groups))
-    valid_weeks = []
-
-    for epiweek in period:
-        valid_weeks.append(epiweek)
-
-        for l_idx in range(len(locations)):
-            location = locations[l_idx]
-
-            for g_idx in range(len(groups)):
-                group = groups[g_idx]
+    model_upper, model, model_lower = get_models(data, 
+                                                locations, groups, 
+                                                model_periods, lag, 
+                                                left_window, right_window, backfill_window, 
+                                                model_type, model_cache, 
+                                                max_left, max_backfill)
+    # validation inputs are fetched once with the maximum window and backfill
+    val_key = ('validation', tuple(locations), tuple(groups), tuple(time_period), 
+                lag, max_left, right_window, max_backfill)
+    if val_key not in model_cache:
+        model_cache[val_key] = collect_validation(data, 
+                                                locations, groups, 
+                                                valid_weeks, lag, 
+                                                max_left, right_window, max_backfill)
+    X_val, inds, cur_truth, ground_truth, valid_counts, week_pos = model_cache[val_key]
+
+    if return_sums:
+        if len(X_val) == 0:
+            return 0.0, 0.0, 0
+        X_val = X_val[:, preparation.select_columns(max_left, right_window, max_backfill, 
+                                                    left_window, backfill_window)]
+        truth = ground_truth[tuple(inds)].astype(np.float64)
+        residual = truth - model.predict(X_val)
+        centered = truth - truth.mean()
+        return np.dot(residual, residual), np.dot(centered, centered), len(truth)
 
-                # if data exists, perform cross-validation
-                if (epiweek, group, location) in data:
-                    x_val, cur_y_val, y_val = preparation.fetch(data, location, group, 
-                                                                epiweek, lag, 
-                                                                left_window, right_window, 
-                                                                backfill_window)
-                    pred = model.predict(x_val.T)
-                    pred_u = model_upper.predict(x_val.T)
-                    pred_l = model_lower.predict(x_val.T)
-                    # record results
-                    predictions[l_idx][g_idx].append(pred)
-                    predictions_lower[l_idx][g_idx].append(pred_l)
-                    predictions_upper[l_idx][g_idx].append(pred_u)
-                    # record ground truth
-                    cur_truth[l_idx][g_idx].append(cur_y_val)
-                    ground_truth[l_idx][g_idx].append(y_val)
+    # result collectors
+    predictions = np.full(ground_truth.shape, np.nan, dtype=np.float32)
+    predictions_lower = np.full(ground_truth.shape, np.nan, dtype=np.float32)
+    predictions_upper = np.full(ground_truth.shape, np.nan, dtype=np.float32)
+
+    if len(X_val) > 0:
+        X_val = X_val[:, preparation.select_columns(max_left, right_window, max_backfill, 
+                                                    left_window, backfill_window)]
+        l_inds, g_inds, w_inds = inds
+        # record results
+        if model_type in CLOSED_FORM_MODELS:
+            # linear models predict all quantiles in one pass
+            terms = [cur_model.get_linear_terms() 
+                    for cur_model in (model_upper, model, model_lower)]
+            quantiles = regression_kernels.triple_predict(
+                            X_val, 
+                            np.stack([coef for coef, _ in terms]), 
+                            np.array([intercept for _, intercept in terms]))
+            predictions_upper[l_inds, g_inds, w_inds] = quantiles[:, 0]
+            predictions[l_inds, g_inds, w_inds] = quantiles[:, 1]
+            predictions_lower[l_inds, g_inds, w_inds] = quantiles[:, 2]
+        else:
+            predictions[l_inds, g_inds, w_inds] = model.predict(X_val)
+            predictions_upper[l_inds, g_inds, w_inds] = model_upper.predict(X_val)
+            predictions_lower[l_inds, g_inds, w_inds] = model_lower.predict(X_val)
     
     return valid_weeks, predictions, predictions_lower, predictions_upper, \
-        cur_truth, ground_truth
+        cur_truth, ground_truth, valid_counts, week_pos
 
 def nowcast_report(path, data, 
                     locations, groups, 
                     time_period, 
                     left_window, backfill_window, 
-                    mode, model_type):
+                    mode, model_type, model_cache=None, max_left=None, max_backfill=None):
     """
-    calculate metric for linear regression and plot prediction results.
+    run cross-validation for linear regression and plot prediction results.
 
     Args:
         path - the path where tables and graphs are generated.
@@ -178,55 +358,65 @@ def nowcast_report(path, data,
             prev: use the seasons within year window as training data
             all: use all previous seasons as training data
         model_type - the machine learning model used
+        model_cache - (optional) a dictionary of trained models shared across calls
+        max_left, max_backfill - (optional) the largest left window and backfill 
+            sharing the training and validation data
     
     Returns:
-        rsq - the explained variance statistics of prediction
-        mse - the mean squared error of prediction
+        predictions - the predicted final values
+        ground_truth - the final values provided by CDC after backfill
+        valid_counts - the number of recorded epiweeks for each location and group
     """
-    # result collectors
-    rsq = create_double_list(None, len(locations), len(groups))
-    mse = create_double_list(None, len(locations), len(groups))
-    # run cross validation and calculate statistics
+    # run cross validation
     valid_weeks, \
     predictions, predictions_lower, predictions_upper, \
-    cur_truth, ground_truth = \
+    cur_truth, ground_truth, valid_counts, week_pos = \
     validate(data, 
             locations, groups,
             time_period, lag=0, 
             left_window=left_window, right_window=0, 
             backfill_window=backfill_window, 
-            mode=mode, model_type=model_type)
+            mode=mode, model_type=model_type, 
+            model_cache=model_cache, max_left=max_left, max_backfill=max_backfill)
+    # plot with epiweeks as ticks for x-axis
+    inds = range(len(valid_weeks))
+    week_ticks = [str(epiweek % 100) for epiweek in valid_weeks]
+    # the figure is reused for all locations and groups
+    fig, ax = plt.subplots()
 
     for l_idx in range(len(locations)):
         location = locations[l_idx]
 
         for g_idx in range(len(groups)): 
             group = groups[g_idx]
-            rsq[l_idx][g_idx] = metrics.r2_score(
-                                ground_truth[l_idx][g_idx], predictions[l_idx][g_idx])
-            mse[l_idx][g_idx] = metrics.mean_squared_error(
-                                ground_truth[l_idx][g_idx], predictions[l_idx][g_idx])
-            # plot with epiweeks as ticks for x-axis
-            inds = range(len(valid_weeks))
-            week_ticks = [str(epiweek % 100) for epiweek in valid_weeks]
+            # records are packed from the start, place them at their epiweeks
+            # and leave gaps for the missing ones
+            count = valid_counts[l_idx, g_idx]
+            series = np.full((5, len(valid_weeks)), np.nan, dtype=np.float32)
+            series[:, week_pos[l_idx, g_idx, :count]] = [predictions[l_idx, g_idx, :count], 
+                                    predictions_upper[l_idx, g_idx, :count], 
+                                    predictions_lower[l_idx, g_idx, :count], 
+                                    cur_truth[l_idx, g_idx, :count], 
+                                    ground_truth[l_idx, g_idx, :count]]
             # plot predicted rate, true rate, and current rate
-            plt.figure()
-            plt.plot(inds, predictions[l_idx][g_idx], label='predicted rate')
-            plt.plot(inds, predictions_upper[l_idx][g_idx], label='predicted rate upper bound')
-            plt.plot(inds, predictions_lower[l_idx][g_idx], label='predicted rate lower bound')
-            plt.plot(inds, cur_truth[l_idx][g_idx], label='current rate')
-            plt.plot(inds, ground_truth[l_idx][g_idx], label='true rate')
-            plt.xticks(inds, week_ticks, rotation='vertical')
-            plt.xlabel('weeks')
-            plt.ylabel('hospitalized rate')
-            plt.legend()
-            plt.savefig(path + '/' + location + '/' + str(group) + '-' +
-                        str(left_window) + '-' + str(backfill_window) + '.png', dpi=300)
-            plt.close()
+            ax.cla()
+            ax.plot(inds, series[0], label='predicted rate')
+            ax.plot(inds, series[1], label='predicted rate upper bound')
+            ax.plot(inds, series[2], label='predicted rate lower bound')
+            ax.plot(inds, series[3], label='current rate')
+            ax.plot(inds, series[4], label='true rate')
+            ax.set_xticks(inds)
+            ax.set_xticklabels(week_ticks, rotation='vertical')
+            ax.set_xlabel('weeks')
+            ax.set_ylabel('hospitalized rate')
+            ax.legend()
+            fig.savefig(path + '/' + location + '/' + str(group) + '-' +
+                        str(left_window) + '-' + str(backfill_window) + '.png', dpi=150)
         
-    return rsq, mse
+    plt.close(fig)
+    return predictions, ground_truth, valid_counts
 
-def plot_results(path, results, name, location, group, colormap):
+def plot_results(path, results, name, location, group, colormap, ax=None):
     """
     plot the mse / rsq results as heatmap for each location and group.
 
@@ -237,28 +427,122 @@ def plot_results(path, results, name, location, group, colormap):
         locations - the location to report
         groups - the group to report
         colormap - the colormap used for heatmap
+        ax - (optional) an existing axes to draw on, which is cleared and kept open.
+            otherwise a new figure is created and closed.
     
     Returns:
         None
     """
-    length, width = results.shape
-    fig, ax = plt.subplots()
-    ax.imshow(results, cmap=colormap)
+    # only the lower triangle (i.e. backfill <= window) holds results
+    mask = np.triu(np.ones_like(results, dtype=bool), k=1)
+    if ax is None:
+        fig, ax = plt.subplots()
+        close = True
+    else:
+        fig = ax.figure
+        ax.cla()
+        close = False
+    # fill each square by statistic
+    sns.heatmap(results, cmap=colormap, mask=mask, 
+                annot=True, fmt='.2f', annot_kws={'color': 'w'}, 
+                cbar=False, square=True, xticklabels=True, yticklabels=True, ax=ax)
 
     ax.set_title(GROUP_DESCRIPTIONS[group])
     ax.set_ylabel('window')
     ax.set_xlabel('backfill')
-    ax.set_yticks(range(length))
-    ax.set_xticks(range(width))
-
-    # fill each square by statistic
-    for i in range(length):
-        for j in range(i+1):
-            ax.text(j, i, '{:.2f}'.format(results[i][j]), ha='center', va='center', color='w')
     
     fig.tight_layout()
-    plt.savefig(path + '/' + location + '/' + name + '_results_' + str(group) + '.png', dpi=300)
+    fig.savefig(path + '/' + location + '/' + name + '_results_' + str(group) + '.png', dpi=150)
+    if close:
+        plt.close(fig)
+
+def run_group_experiment(data, 
+                        locations, groups, 
+                        time_periods, 
+                        max_window, 
+                        mode, model_type):
+    """
+    run nowcast experiments of a location group and an age grouping 
+    for different time periods.
+
+    Args:
+        data - the data source (included all epiweeks with all lags)
+        locations - the locations in the group
+        groups - the age groups in the grouping
+        time_periods - a list of time period (strings representing the starting and ending epiweek)
+        max_window - the maximum time window considered in experiment
+        mode - the training scheme.
+            prev: use the seasons within year window as training data
+            all: use all previous seasons as training data
+        model_type - the machine learning model used
+    
+    Returns:
+        results - a list of ((period, group), rsq) records in experiment order
+    """
+    results = []
+    num_loc, num_group = len(locations), len(groups)
+    # trained models only depend on the training seasons, so the cache
+    # is shared by the periods of a season and cleared afterwards
+    model_cache, cache_year = {}, None
+    # the heatmap figure is reused for all results
+    fig, ax = plt.subplots()
+
+    for period in time_periods:
+        start_year = hosp_utils.get_start_year(period[0])
+        if start_year != cache_year:
+            model_cache.clear()
+            cache_year = start_year
+        report_path = './nowcast/'+str(period)
+        # the ground truth is shared by all time windows and backfills, 
+        # predictions are stacked as (window, backfill, epiweek)
+        pred_stacks = None
+        # record the predictions for each time window and backfill
+        for window in tqdm(range(max_window + 1)):
+            for backfill in range(window + 1):
+                predictions, ground_truth, _ = \
+                    nowcast_report(report_path, data, 
+                                    locations, groups, 
+                                    period, 
+                                    left_window=window, backfill_window=backfill, 
+                                    mode=mode, model_type=model_type, 
+                                    model_cache=model_cache, 
+                                    max_left=max_window, max_backfill=max_window)
+
+                if pred_stacks is None:
+                    pred_stacks = np.zeros((num_loc, num_group, 
+                                            max_window + 1, max_window + 1, 
+                                            ground_truth.shape[-1]), dtype=np.float32)
+                pred_stacks[:, :, window, backfill] = predictions
+        # score the results of all locations, groups, windows and backfills at once
+        num_grid = (max_window + 1) ** 2
+        rsq_results, mse_results = regression_kernels.r2_mse_bulk(
+            ground_truth.reshape(num_loc * num_group, -1), 
+            pred_stacks.reshape(num_loc * num_group, num_grid, -1))
+        rsq_results = rsq_results.reshape(pred_stacks.shape[:-1]).astype(np.float32)
+        mse_results = mse_results.reshape(pred_stacks.shape[:-1]).astype(np.float32)
+        # only backfill <= window is evaluated
+        upper = np.triu_indices(max_window + 1, 1)
+        rsq_results[:, :, upper[0], upper[1]] = -np.inf
+        mse_results[:, :, upper[0], upper[1]] = -np.inf
+        # plot the results
+        for l_idx in range(num_loc):
+            location = locations[l_idx]
+
+            for g_idx in range(num_group):
+                group = groups[g_idx]
+                # locations and groups without ground truth are not reported
+                if np.isnan(rsq_results[l_idx, g_idx, 0, 0]):
+                    continue
+
+                plot_results(report_path, mse_results[l_idx, g_idx], 
+                            'mse', location, group, 'Reds', ax)
+                plot_results(report_path, rsq_results[l_idx, g_idx], 
+                            'rsq', location, group, 'Blues', ax)
+                # set the maximum as model metric
+                results.append(((period, group), np.amax(rsq_results[l_idx, g_idx])))
+
     plt.close(fig)
+    return results
 
 def run_nowcast_experiment(data, 
                             location_groups, groupings, 
@@ -282,55 +566,136 @@ def run_nowcast_experiment(data,
     Returns:
         None
     """
-    # matrix for recording results, will be copied for each entry
     results = {}
-    mse_record_mat = np.full((max_window + 1, max_window + 1), -np.inf)
-    rsq_record_mat = np.full((max_window + 1, max_window + 1), -np.inf)
 
     for period in time_periods:
         # create path for writing reports
         report_path = './nowcast/'+str(period)
-        if not os.path.exists(report_path):
-            os.makedirs(report_path)
+        os.makedirs(report_path, exist_ok=True)
         # create path for each state
         for state in STATE_LIST:
             cur_path = report_path + '/' + state
-            if not os.path.exists(cur_path):
-                os.makedirs(cur_path)
-        # obtain results for each group and location under grouping
-        for locations in tqdm(location_groups):
-            for groups in groupings:
-                mse_results = create_double_list(mse_record_mat, len(locations), len(groups))
-                rsq_results = create_double_list(rsq_record_mat, len(locations), len(groups))
-                # record the result for each time window and backfill
-                for window in tqdm(range(max_window + 1)):
-                    for backfill in range(window + 1):
-                        rsq, mse = nowcast_report(report_path, data, 
-                                                locations, groups, 
-                                                period, 
-                                                left_window=window, backfill_window=backfill, 
-                                                mode=mode, model_type=model_type)
-
-                        for l_idx in range(len(locations)):
-                            for g_idx in range(len(groups)):
-                                mse_results[l_idx][g_idx][window][backfill] = mse[l_idx][g_idx]
-                                rsq_results[l_idx][g_idx][window][backfill] = rsq[l_idx][g_idx]
-                # plot the results
-                for l_idx in range(len(locations)):
-                    location = locations[l_idx]
-
-                    for g_idx in range(len(groups)):
-                        group = groups[g_idx]
-
-                        plot_results(report_path, mse_results[l_idx][g_idx], 
-                                    'mse', location, group, 'Reds')
-                        plot_results(report_path, rsq_results[l_idx][g_idx], 
-                                    'rsq', location, group, 'Blues')
-                        # set the maximum as model metric
-                        results[(period, group)] = np.amax(rsq_results[l_idx][g_idx])
+            os.makedirs(cur_path, exist_ok=True)
+    # the data source is passed to the workers as arrays, which joblib 
+    # memory-maps once instead of pickling a dictionary for each task
+    data = preparation.to_npz_data(data)
+    # obtain results for each group and location under grouping in parallel, 
+    # processes are always used since pyplot is not thread-safe. 
+    # the cores are split between the processes and the threads within them
+    inner_threads = max(1, cpu_count() // effective_n_jobs(N_JOBS))
+    with parallel_backend('loky', inner_max_num_threads=inner_threads):
+        group_results = Parallel(n_jobs=N_JOBS)(
+                            delayed(run_group_experiment)(data, 
+                                                        locations, groups, 
+                                                        time_periods, 
+                                                        max_window, 
+                                                        mode, model_type)
+                            for locations in location_groups for groups in groupings)
+    # merge in experiment order
+    for records in group_results:
+        for key, rsq in records:
+            results[key] = rsq
 
     write_data(results, './nowcast/results.txt')
 
+def predict_group(data, epiweek, 
+                locations, groups, 
+                max_window, 
+                mode, model_type):
+    """
+    perform prediction of a location group and an age grouping for specific epiweek.
+
+    Args:
+        data - the data source
+        epiweek - the epiweek for which we predict the final value
+        locations - the locations in the group
+        groups - the age groups in the grouping
+        max_window - the maximum time window considered in modeling
+        mode - the training scheme.
+            prev: use the seasons within year window as training data
+            all: use all previous seasons as training data
+        model_type - the type of machine learning model used
+    
+    Returns:
+        cur_preds, cur_preds_upper, cur_preds_lower - the prediction results 
+            for each location and group
+    """
+    # create cross-validation period
+    start_year = hosp_utils.get_start_year(epiweek)
+    val_period = hosp_utils.get_period(start_year - 1, 40, 17)
+
+    cur_preds = np.empty((len(locations), len(groups)))
+    cur_preds_upper = np.empty((len(locations), len(groups)))
+    cur_preds_lower = np.empty((len(locations), len(groups)))
+
+    opt_window = 0
+    cur_rsq = 0.0
+    stale = 0
+
+    # perform cross-validation and select the optimal hyperparameters, 
+    # i.e. window and backfill
+    for window in range(0, max_window + 1):
+        # R^2 is at most 1 and the penalty grows with the window, so larger windows
+        # cannot win once the bound falls behind. as a heuristic, the sweep also
+        # stops after PATIENCE windows without improvement.
+        if 1.0 - PENALTY * window <= cur_rsq or stale >= PATIENCE:
+            break
+
+        ss_res, ss_tot, n = validate(data, 
+                                    locations, groups, 
+                                    val_period, lag=0, 
+                                    left_window=window, right_window=0, 
+                                    backfill_window=window,
+                                    model_type=model_type, mode=mode, 
+                                    return_sums=True)
+        # calculate R^2 over the recorded epiweeks and compare,
+        # following sklearn for constant ground truth
+        if ss_tot > 0.0:
+            rsq = 1.0 - ss_res / ss_tot
+        else:
+            rsq = float(n > 0 and ss_res == 0.0)
+        rsq = rsq - PENALTY * window
+
+        if rsq > cur_rsq:
+            opt_window = window
+            cur_rsq = rsq
+            stale = 0
+        else:
+            stale += 1
+    
+    # use validation period (i.e. the latest) to train the model
+    # and then make predictions
+    X, Y = preparation.prepare(data, 
+                            locations, groups, 
+                            [val_period], lag=0, 
+                            left_window=opt_window, right_window=0, 
+                            backfill_window=opt_window)
+    # get trained model and residuals
+    model_upper, model, model_lower = train_model(X, Y, model_type)
+
+    for l_idx in range(len(locations)):
+        location = locations[l_idx]
+
+        for g_idx in range(len(groups)):
+            group = groups[g_idx]
+            X_pred, _, _ = preparation.fetch(data, 
+                                            location, group, 
+                                            epiweek, lag=0, 
+                                            left_window=opt_window, right_window=0, 
+                                            backfill_window=opt_window)
+            # fetched rows are already C-contiguous model inputs
+            assert X_pred.flags['C_CONTIGUOUS']
+            # get results from prediction 
+            pred_u = model_upper.predict(X_pred)
+            pred = model.predict(X_pred)
+            pred_l = model_lower.predict(X_pred)
+            # add to records
+            cur_preds[l_idx, g_idx] = pred[0]
+            cur_preds_upper[l_idx, g_idx] = pred_u[0]
+            cur_preds_lower[l_idx, g_idx] = pred_l[0]
+
+    return cur_preds, cur_preds_upper, cur_preds_lower
+
 def predict(data, epiweek, 
             location_groups, groupings, 
             max_window, 
@@ -342,7 +707,9 @@ def predict(data, epiweek,
     
     choose slabs (i.e. window and backfill window) as following:
         consider combinations (0, 0), (1, 1), (2, 2),
-        add R^2 penalty of 0.04 * window_size
+        add R^2 penalty of 0.04 * window_size,
+        stop when the penalty rules out larger windows, or after 
+        PATIENCE windows without improvement
 
     Args:
         data - the data source
@@ -358,80 +725,33 @@ def predict(data, epiweek,
     Returns:
         preds, preds_upper, preds_lower - the prediction results
     """
-    # create cross-validation period
-    start_year = hosp_utils.get_start_year(epiweek)
     max_window = min(max_window, hosp_utils.get_max_window(epiweek))
-    val_period = hosp_utils.get_period(start_year - 1, 40, 17)
     preds, preds_upper, preds_lower = {}, {}, {}
+    # each location group and age grouping is predicted independently, 
+    # threads suffice for models spending their time in BLAS
+    backend = 'threading' if model_type in CLOSED_FORM_MODELS else 'loky'
+    if backend == 'loky':
+        # processes receive the data source as memory-mapped arrays
+        data = preparation.to_npz_data(data)
+    combinations = [(locations, groups) 
+                    for locations in location_groups for groups in groupings]
+    group_preds = Parallel(n_jobs=N_JOBS, backend=backend)(
+                        delayed(predict_group)(data, epiweek, 
+                                                locations, groups, 
+                                                max_window, 
+                                                mode, model_type)
+                        for locations, groups in combinations)
 
-    for lg_idx in range(len(location_groups)):
-        locations = location_groups[lg_idx]
-
-        for gp_idx in range(len(groupings)):
-            groups = groupings[gp_idx]
-
-            cur_preds = create_double_list([], len(locations), len(groups))
-            cur_preds_upper = create_double_list([], len(locations), len(groups))
-            cur_preds_lower = create_double_list([], len(locations), len(groups))
-
-            opt_window = 0
-            cur_rsq = 0.0
+    for (locations, groups), (cur_preds, cur_preds_upper, cur_preds_lower) in \
+            zip(combinations, group_preds):
+        for l_idx in range(len(locations)):
+            location = locations[l_idx]
 
-            # perform cross-validation and select the optimal hyperparameters, 
-            # i.e. window and backfill
-            for window in range(0, max_window + 1):
-                _, predictions, _, _, _, ground_truth = validate(data, 
-                                                        locations, groups, 
-                                                        val_period, lag=0, 
-                                                        left_window=window, right_window=0, 
-                                                        backfill_window=window,
-                                                        model_type=model_type, mode=mode)
-                # calculate metrics and compare
-                predictions = np.vstack(flatten_double_list(predictions)).squeeze()
-                ground_truth = np.vstack(flatten_double_list(ground_truth)).squeeze()
-                rsq = metrics.r2_score(ground_truth, predictions) - PENALTY * window
-
-                if rsq > cur_rsq:
-                    opt_window = window
-                    cur_rsq = rsq
-            
-            # use validation period (i.e. the latest) to train the model
-            # and then make predictions
-            X, Y = preparation.prepare(data, 
-                                    locations, groups, 
-                                    [val_period], lag=0, 
-                                    left_window=opt_window, right_window=0, 
-                                    backfill_window=opt_window)
-            # get trained model and residuals
-            model_upper, model, model_lower = train_model(X, Y, model_type)
-
-            for l_idx in range(len(locations)):
-                location = locations[l_idx]
-
-                for g_idx in range(len(groups)):
-                    group = groups[g_idx]
-                    X_pred, _, _ = preparation.fetch(data, 
-                                                    location, group, 
-                                                    epiweek, lag=0, 
-                                                    left_window=opt_window, right_window=0, 
-                                                    backfill_window=opt_window)
-                    # get results from prediction 
-                    pred_u = model_upper.predict(X_pred.T)
-                    pred = model.predict(X_pred.T)
-                    pred_l = model_lower.predict(X_pred.T)
-                    # add to records
-                    cur_preds[l_idx][g_idx].append(pred)
-                    cur_preds_upper[l_idx][g_idx].append(pred_u)
-                    cur_preds_lower[l_idx][g_idx].append(pred_l)
-            
-            for l_idx in range(len(locations)):
-                location = locations[l_idx]
-
-                for g_idx in range(len(groups)):
-                    group = groups[g_idx]
-                    # assign predictions to locations and groups
-                    preds[(location, group)] = cur_preds[l_idx][g_idx][0][0]
-                    preds_upper[(location, group)] = cur_preds_upper[l_idx][g_idx][0][0]
-                    preds_lower[(location, group)] = cur_preds_lower[l_idx][g_idx][0][0]
+            for g_idx in range(len(groups)):
+                group = groups[g_idx]
+                # assign predictions to locations and groups
+                preds[(location, group)] = cur_preds[l_idx, g_idx]
+                preds_upper[(location, group)] = cur_preds_upper[l_idx, g_idx]
+                preds_lower[(location, group)] = cur_preds_lower[l_idx, g_idx]
 
     return preds, preds_upper, preds_lower
@@ -0,0 +1,130 @@
+"""
+batched kernels for the nowcast experiment.
+
+The scores of all locations, groups and (window, backfill) combinations are
+computed at once from stacked predictions, and linear models predict all
+quantiles at once. numba is used when installed, otherwise the kernels fall
+back to vectorized numpy.
+"""
+# third party
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def r2_mse_bulk(y_true, y_pred):
+        """
+        calculate the R^2 statistics and mean squared errors of stacked predictions.
+
+        Args:
+            y_true - the ground truth of shape (C, N), nan entries are ignored
+            y_pred - the predictions of shape (C, K, N), i.e. K predictions 
+                of each ground truth series
+
+        Returns:
+            rsq, mse - the R^2 statistics and mean squared errors of shape (C, K),
+                nan for series without ground truth
+        """
+        cells, settings, n = y_pred.shape
+        rsq = np.empty((cells, settings))
+        mse = np.empty((cells, settings))
+
+        for c in prange(cells):
+            count, total = 0, 0.0
+            for k in range(n):
+                if not np.isnan(y_true[c, k]):
+                    count += 1
+                    total += y_true[c, k]
+            # series without ground truth are not scored
+            if count == 0:
+                for s in range(settings):
+                    rsq[c, s] = np.nan
+                    mse[c, s] = np.nan
+                continue
+            mean = total / count
+            ss_tot = 0.0
+            for k in range(n):
+                if not np.isnan(y_true[c, k]):
+                    ss_tot += (y_true[c, k] - mean) ** 2
+
+            for s in range(settings):
+                ss_res = 0.0
+                for k in range(n):
+                    if not np.isnan(y_true[c, k]):
+                        ss_res += (y_true[c, k] - y_pred[c, s, k]) ** 2
+                # follow sklearn for constant ground truth
+                if ss_tot == 0.0:
+                    rsq[c, s] = 1.0 if ss_res == 0.0 else 0.0
+                else:
+                    rsq[c, s] = 1.0 - ss_res / ss_tot
+                mse[c, s] = ss_res / count
+        return rsq, mse
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def triple_predict(X, W, B):
+        """
+        predict the upper, mid and lower quantiles of linear models.
+
+        Args:
+            X - the inputs of shape (N, d)
+            W - the coefficients of the quantile models, of shape (3, d)
+            B - the intercepts of the quantile models, of shape (3,)
+
+        Returns:
+            the predictions of shape (N, 3)
+        """
+        out = np.empty((X.shape[0], 3))
+        for i in prange(X.shape[0]):
+            for q in range(3):
+                total = B[q]
+                for j in range(X.shape[1]):
+                    total += X[i, j] * W[q, j]
+                out[i, q] = total
+        return out
+else:
+    def r2_mse_bulk(y_true, y_pred):
+        """
+        calculate the R^2 statistics and mean squared errors of stacked predictions.
+
+        Args:
+            y_true - the ground truth of shape (C, N), nan entries are ignored
+            y_pred - the predictions of shape (C, K, N), i.e. K predictions 
+                of each ground truth series
+
+        Returns:
+            rsq, mse - the R^2 statistics and mean squared errors of shape (C, K),
+                nan for series without ground truth
+        """
+        valid = ~np.isnan(y_true)
+        count = valid.sum(axis=-1)
+        y_true = np.where(valid, np.asarray(y_true, dtype=np.float64), 0.0)
+        mean = y_true.sum(axis=-1, keepdims=True) / np.maximum(count, 1)[:, None]
+
+        ss_tot = (np.where(valid, y_true - mean, 0.0) ** 2).sum(axis=-1)[:, None]
+        ss_res = (np.where(valid[:, None], y_true[:, None] - y_pred, 0.0) ** 2).sum(axis=-1)
+        # follow sklearn for constant ground truth
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsq = np.where(ss_tot == 0.0, np.where(ss_res == 0.0, 1.0, 0.0), 
+                            1.0 - ss_res / ss_tot)
+            mse = ss_res / count[:, None]
+        # series without ground truth are not scored
+        rsq[count == 0] = np.nan
+        return rsq, mse
+
+    def triple_predict(X, W, B):
+        """
+        predict the upper, mid and lower quantiles of linear models.
+
+        Args:
+            X - the inputs of shape (N, d)
+            W - the coefficients of the quantile models, of shape (3, d)
+            B - the intercepts of the quantile models, of shape (3,)
+
+        Returns:
+            the predictions of shape (N, 3)
+        """
+        return np.dot(X, W.T) + B
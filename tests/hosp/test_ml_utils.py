@@ -0,0 +1,51 @@
+"""Unit tests for ml_utils.py."""
+
+# standard library
+import unittest
+
+# third party
+import numpy as np
+from sklearn.linear_model import LinearRegression, Ridge
+
+# py3tester coverage target
+__test_target__ = 'flu_contest.src.hosp.ml_utils'
+
+
+class Tests(unittest.TestCase):
+  """Generic unit tests."""
+
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.X = rng.rand(50, 8).astype(np.float32)
+    self.y = (np.dot(self.X, rng.rand(8)) + 0.1 * rng.rand(50)).astype(np.float32)
+
+  def assertMatches(self, actual, model):
+    coef, intercept = actual
+    self.assertTrue(np.allclose(coef, model.coef_, atol=1e-6))
+    self.assertAlmostEqual(intercept, model.intercept_, places=6)
+
+  def test_gram_stats_solve(self):
+    stats = GramStats(self.X, self.y)
+    X = self.X.astype(np.float64)
+
+    for cols in ([0, 1, 2], [5, 2, 7], list(range(8))):
+      cols = np.array(cols)
+      with self.subTest(cols=cols, model='linear'):
+        model = LinearRegression().fit(X[:, cols], self.y)
+        self.assertMatches(stats.solve(cols, 0.0), model)
+      with self.subTest(cols=cols, model='ridge'):
+        model = Ridge(alpha=1.0).fit(X[:, cols], self.y)
+        self.assertMatches(stats.solve(cols, 1.0), model)
+
+  def test_gram_stats_solve_prefix(self):
+    stats = GramStats(self.X, self.y)
+    X = self.X.astype(np.float64)
+    order = np.array([6, 1, 3, 0, 7, 2])
+
+    # prefixes of the order, and a subset that is not a prefix
+    for cols in (order[:1], order[:4], order, order[[1, 0, 2]], np.array([6, 2])):
+      for alpha in (1.0, 0.5):
+        with self.subTest(cols=cols, alpha=alpha):
+          model = Ridge(alpha=alpha).fit(X[:, cols], self.y)
+          self.assertMatches(stats.solve(cols, alpha, order), model)
+
@@ -0,0 +1,138 @@
+"""Unit tests for preparation.py."""
+
+# standard library
+import os
+import tempfile
+import unittest
+
+# third party
+import numpy as np
+
+# py3tester coverage target
+__test_target__ = 'flu_contest.src.hosp.preparation'
+
+
+class Tests(unittest.TestCase):
+  """Generic unit tests."""
+
+  def test_fetch_batch_short_record(self):
+    # the window reaches past the tabulated lags of the record
+    series = np.arange(2 * 10 * 4, dtype=np.float64).reshape(2, 10, 4)
+    lengths = np.full((2, 10), 4, dtype=np.intp)
+    cells = np.array([0], dtype=np.intp)
+    weeks = np.array([8], dtype=np.intp)
+
+    with self.subTest(path='python'):
+      with self.assertRaises(ValueError):
+        _fetch_batch(series, lengths, cells, weeks, 0, 6, 0, 2)
+
+    if _compiled_fetch_batch is not None:
+      with self.subTest(path='compiled'):
+        with self.assertRaises(ValueError):
+          _compiled_fetch_batch(series, lengths, cells, weeks, 0, 6, 0, 2)
+
+  def setUp(self):
+    # records of uneven length over 30 epiweeks, with a few missing
+    rng = np.random.RandomState(0)
+    self.locations, self.groups = ['CA', 'NY'], [0, 2]
+    self.epiweeks = list(range(201801, 201831))
+    self.data = {}
+    for location in self.locations:
+      for group in self.groups:
+        for epiweek in self.epiweeks:
+          if rng.rand() < 0.9:
+            length = rng.randint(9, 12)
+            self.data[(epiweek, group, location)] = list(rng.rand(length))
+
+  def fetch_all(self, lag, left_window, right_window, backfill_window):
+    # tabulate around the middle epiweeks and fetch them in both ways
+    first, last = 201810, 201820
+    series, lengths, week_index = tabulate(self.data, self.locations, self.groups, 
+                                          first - left_window, last + right_window)
+    cells, weeks, rows = [], [], []
+    for l_idx, location in enumerate(self.locations):
+      for g_idx, group in enumerate(self.groups):
+        for epiweek in range(first, last + 1):
+          if (epiweek, group, location) in self.data:
+            x, _, _ = fetch(self.data, location, group, epiweek, 
+                            lag, left_window, right_window, backfill_window)
+            cells.append(l_idx * len(self.groups) + g_idx)
+            weeks.append(week_index[epiweek])
+            rows.append(x)
+    return series, lengths, np.array(cells), np.array(weeks), np.vstack(rows)
+
+  def test_fetch(self):
+    x, cur_y, y = fetch(self.data, 'CA', 0, 201815, 1, 3, 1, 2)
+    self.assertEqual(x.shape, (1, 5 * 3))
+    self.assertTrue(x.flags['C_CONTIGUOUS'])
+    self.assertEqual(cur_y, self.data[(201815, 0, 'CA')][1])
+
+  def test_fetch_batch(self):
+    for lag, left_window, right_window, backfill_window in (
+      (0, 0, 0, 0),
+      (0, 3, 0, 2),
+      (2, 3, 0, 3),
+      (1, 2, 2, 1),
+      (2, 4, 1, 4),
+    ):
+      series, lengths, cells, weeks, expected = \
+        self.fetch_all(lag, left_window, right_window, backfill_window)
+      args = (series, lengths, cells, weeks, 
+              lag, left_window, right_window, backfill_window)
+      with self.subTest(path='dispatch', lag=lag, left=left_window, right=right_window):
+        self.assertTrue(np.allclose(fetch_batch(*args), expected))
+      with self.subTest(path='python', lag=lag, left=left_window, right=right_window):
+        self.assertTrue(np.allclose(_fetch_batch(*args), expected))
+      if _compiled_fetch_batch is not None:
+        with self.subTest(path='compiled', lag=lag, left=left_window, right=right_window):
+          actual = _compiled_fetch_batch(series, lengths, 
+                                        cells.astype(np.intp), weeks.astype(np.intp), 
+                                        lag, left_window, right_window, backfill_window)
+          self.assertTrue(np.allclose(actual, expected))
+
+  def test_select_columns(self):
+    _, _, _, _, X = self.fetch_all(1, 4, 1, 3)
+    for left_window in range(5):
+      for backfill_window in range(4):
+        with self.subTest(left=left_window, backfill=backfill_window):
+          _, _, _, _, expected = self.fetch_all(1, left_window, 1, backfill_window)
+          cols = select_columns(4, 1, 3, left_window, backfill_window)
+          # the same predictors, in backfill order
+          order = select_columns(left_window, 1, backfill_window, 
+                                left_window, backfill_window)
+          self.assertTrue(np.allclose(X[:, cols], expected[:, order]))
+          # smaller backfills form prefixes within a window
+          order = select_columns(4, 1, 3, left_window, 3)
+          self.assertTrue(np.array_equal(cols, order[:len(cols)]))
+
+  def test_npz_round_trip(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'data.npz')
+      write_npz(self.data, path)
+      stored = load_npz(path)
+
+      self.assertEqual(len(stored), len(self.data))
+      self.assertEqual(set(stored), set(self.data))
+      for key, record in self.data.items():
+        self.assertIn(key, stored)
+        self.assertTrue(np.array_equal(stored[key], record))
+      self.assertNotIn((201801, 1, 'CA'), stored)
+      self.assertNotIn((201801, 0, 'PA'), stored)
+      self.assertNotIn((201801, 5, 'NY'), stored)
+      with self.assertRaises(KeyError):
+        stored[(201801, 1, 'CA')]
+      # tabulated records match the dictionary source
+      series, lengths, week_index = \
+        tabulate(stored, self.locations, self.groups, 201805, 201825)
+      exp_series, exp_lengths, exp_week_index = \
+        tabulate(self.data, self.locations, self.groups, 201805, 201825)
+      self.assertEqual(week_index, exp_week_index)
+      self.assertTrue(np.array_equal(lengths, exp_lengths))
+      self.assertTrue(np.array_equal(series, exp_series))
+      # a subset of locations and groups
+      for actual, expected in zip(tabulate(stored, ['NY'], [2], 201801, 201803), 
+                                  tabulate(self.data, ['NY'], [2], 201801, 201803)):
+        if isinstance(expected, dict):
+          self.assertEqual(actual, expected)
+        else:
+          self.assertTrue(np.array_equal(actual, expected))
@@ -0,0 +1,59 @@
+"""Unit tests for regression_kernels.py."""
+
+# standard library
+import unittest
+
+# third party
+import numpy as np
+from sklearn.metrics import mean_squared_error, r2_score
+
+# py3tester coverage target
+__test_target__ = 'flu_contest.src.hosp.regression_kernels'
+
+
+class Tests(unittest.TestCase):
+  """Generic unit tests."""
+
+  def test_r2_mse_bulk(self):
+    rng = np.random.RandomState(0)
+    y_true = rng.rand(4, 20).astype(np.float32)
+    y_pred = rng.rand(4, 3, 20).astype(np.float32)
+    # missing entries, constant truth with exact and inexact predictions
+    y_true[0, 5:9] = np.nan
+    y_true[1, -3:] = np.nan
+    y_true[2] = 0.5
+    y_true[3] = 0.25
+    y_pred[3, 0] = 0.25
+
+    rsq, mse = r2_mse_bulk(y_true, y_pred)
+
+    self.assertEqual(rsq.shape, (4, 3))
+    self.assertEqual(mse.shape, (4, 3))
+    for c in range(4):
+      valid = ~np.isnan(y_true[c])
+      for k in range(3):
+        with self.subTest(cell=c, setting=k):
+          truth, pred = y_true[c, valid], y_pred[c, k, valid]
+          self.assertAlmostEqual(rsq[c, k], r2_score(truth, pred), places=5)
+          self.assertAlmostEqual(mse[c, k], mean_squared_error(truth, pred), places=5)
+
+  def test_r2_mse_bulk_without_truth(self):
+    y_true = np.full((2, 5), np.nan, dtype=np.float32)
+    y_true[1] = np.arange(5)
+    y_pred = np.zeros((2, 2, 5), dtype=np.float32)
+
+    rsq, mse = r2_mse_bulk(y_true, y_pred)
+
+    self.assertTrue(np.all(np.isnan(rsq[0])))
+    self.assertTrue(np.all(np.isnan(mse[0])))
+    self.assertFalse(np.any(np.isnan(rsq[1])))
+
+  def test_triple_predict(self):
+    rng = np.random.RandomState(0)
+    X = rng.rand(10, 6).astype(np.float32)
+    W = rng.rand(3, 6)
+    B = rng.rand(3)
+
+    actual = triple_predict(X, W, B)
+
+    self.assertTrue(np.allclose(actual, np.dot(X, W.T) + B, atol=1e-5))